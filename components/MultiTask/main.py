@@ -119,13 +119,17 @@ def main(
     val_dtl = torch.utils.data.DataLoader(val_dts,
                                           batch_size=trainer.args.per_device_eval_batch_size,
                                           num_workers=trainer.args.dataloader_num_workers,
+                                          pin_memory=not trainer.args.no_cuda, # Allows asynchronous host to device copies
                                           shuffle=False, # Important to be aligned with lang list
                                           )
     language_arr = data.loc[val_idx, 'language'].values
 
     # Calculate metrics
     print("Compute metrics on evaluation dataset:")
-    metrics_dct, lang_dct = evaluate_metrics(trainer, val_dtl, language_arr)
+    metrics_dct, lang_dct = evaluate_metrics(trainer, val_dtl, language_arr, train_dct.get('eval_batch_size'))
+    # Metrics and logging only live in the main process
+    if not trainer.is_world_process_zero():
+        return
 
     # Log metrics
     lang_df = pd.DataFrame(lang_dct).reset_index().melt(id_vars='index')
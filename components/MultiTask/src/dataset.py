@@ -24,6 +24,8 @@ class IC_NER_Dataset(torch.utils.data.Dataset):
         self.nlp = nlp
         self.intent2idx = intent2idx
         self.ner2idx = ner2idx
+        # Lookup table to decode NER ids with a single gather (ids are contiguous from 0)
+        self.idx2ner_arr = np.array([k for k,_ in sorted(ner2idx.items(), key=lambda x: x[1])])
         # Extra utilities
         self.label = list(nlp.get_pipe('entity_ruler').labels)
 
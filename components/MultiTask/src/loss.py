@@ -40,7 +40,8 @@ class FocalLoss(torch.nn.Module):
         # Loss parameters
         self.gamma = gamma
         self.temperature = temperature
-        self.class_weights = torch.ones((n_classes)).unsqueeze(dim=-1).to(device) if class_weights is None else class_weights.unsqueeze(dim=-1).to(device)
+        # Registered as buffer so it follows the module across devices
+        self.register_buffer('class_weights', torch.ones((n_classes)).unsqueeze(dim=-1).to(device) if class_weights is None else class_weights.unsqueeze(dim=-1).to(device))
         self.n_classes = n_classes
         self.eps = 1e-6
 
@@ -126,7 +127,9 @@ class IC_NER_Loss(torch.nn.Module):
         """
         super(IC_NER_Loss, self).__init__()
         # Loss config settings
-        self.alpha = torch.nn.Parameter(torch.zeros((1))).to(device)
+        # Create the parameter on device directly; calling .to() on it would return
+        # a plain tensor that is neither registered nor optimised
+        self.alpha = torch.nn.Parameter(torch.zeros((1), device=device))
         if class_weights==None:
             class_weights={'IC':None, 'NER':None}
         self.loss_ic=FocalLoss(gamma, temperature, from_logits, multilabel, reduction, n_classes['IC'], class_weights['IC'], device)
@@ -3,53 +3,109 @@ from .utils import *
 import numpy as np
 from tqdm import tqdm
 import logging as log
-from sklearn.metrics import accuracy_score, f1_score
 import torch
 
 
-def evaluate_metrics(trainer, val_dtl, language_arr):
+# Gather per-rank predictions and restore the original dataset order
+def gather_distributed(sample_idx, arrays, n_samples):
+    gathered = [None]*torch.distributed.get_world_size()
+    torch.distributed.all_gather_object(gathered, (sample_idx, arrays))
+    sample_idx = np.concatenate([elem[0] for elem in gathered])
+    output = []
+    for i, arr in enumerate(arrays):
+        full = np.empty((n_samples,)+arr.shape[1:], dtype=arr.dtype)
+        # DistributedSampler pads with repeated samples, which just overwrite themselves
+        full[sample_idx] = np.concatenate([elem[1][i] for elem in gathered])
+        output.append(full)
+    return output
+
+
+def evaluate_metrics(trainer, val_dtl, language_arr, eval_batch_size:int=None):
     # Setup
-    idx2ner = {v:k for k,v in trainer.eval_dataset.ner2idx.items()}
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    if (eval_batch_size is not None) or distributed:
+        # No gradients are kept in evaluation, so bigger batches fit in memory.
+        # In distributed runs each rank evaluates a disjoint shard
+        num_workers = trainer.args.dataloader_num_workers
+        sampler = torch.utils.data.distributed.DistributedSampler(val_dtl.dataset, shuffle=False) if distributed else None
+        # prefetch_factor is only accepted when data is loaded in worker processes
+        worker_kwargs = {'prefetch_factor':4} if num_workers>0 else {}
+        val_dtl = torch.utils.data.DataLoader(val_dtl.dataset,
+                                              batch_size=eval_batch_size if eval_batch_size is not None else val_dtl.batch_size,
+                                              num_workers=num_workers,
+                                              pin_memory=not trainer.args.no_cuda,
+                                              sampler=sampler,
+                                              shuffle=False, # Important to be aligned with lang list
+                                              **worker_kwargs,
+                                              )
+    idx2ner_arr = trainer.eval_dataset.idx2ner_arr
     device = 'cuda' if not trainer.args.no_cuda else 'cpu'
-    IC_LABELS, IC_OUTPUT, NER_LABELS, NER_OUTPUT = [], [], [], []
+    # Half precision forward; bf16 where the GPU supports it as it cannot overflow
+    amp_dtype = torch.bfloat16 if (not trainer.args.no_cuda and torch.cuda.is_bf16_supported()) else torch.float16
+    # Trainer leaves the model in training mode, so disable dropout explicitly
+    trainer.model.eval()
+    # Compiled forward replays CUDA graphs instead of dispatching each op from Python.
+    # Only the last, smaller batch triggers a recompilation
+    forward_heads = trainer.model.forward_heads
+    if hasattr(torch, 'compile') and not trainer.args.no_cuda:
+        forward_heads = torch.compile(forward_heads, mode='reduce-overhead', dynamic=False)
+    # Labels are written into preallocated host arrays. Predictions are gathered
+    # on device and copied to host once after the loop
+    n_samples = len(val_dtl.sampler)
+    IC_LABELS = np.empty(n_samples, dtype=np.int64)
+    NER_LABELS = np.empty((n_samples, trainer.model.max_length), dtype=np.int64)
+    ic_buf = torch.empty(n_samples, dtype=torch.long, device=device)
+    ner_buf = torch.empty((n_samples, trainer.model.max_length), dtype=torch.long, device=device)
+    offset = 0
     # Create loop with custom metrics
     log.info("Stack predictions:")
-    for batch in tqdm(iter(val_dtl)):
-        # Get labels
-        ic_labels = torch.squeeze(batch.get('labels')[:,:1]).detach().numpy()
-        ner_labels = batch.get('labels')[:,1:].detach().numpy()
-        batch = {k:v.to(device) for k,v in batch.items()}
-        # Get output
-        with torch.no_grad():
-            output = trainer.model(**batch)
-        ic_output = torch.argmax(output[:,:trainer.model.num_labels['IC']], dim=-1).detach().cpu().numpy()
-        ner_output = output[:,trainer.model.num_labels['IC']:].reshape((-1, trainer.model.max_length, trainer.model.num_labels['NER']))
-        ner_output = torch.argmax(ner_output, dim=-1).detach().cpu().numpy()
-        # Decode NER arrays
-        ner_labels = np.vectorize(idx2ner.get)(ner_labels)
-        ner_output = np.vectorize(idx2ner.get)(ner_output)
-        # Append results
-        IC_LABELS.append(ic_labels)
-        IC_OUTPUT.append(ic_output)
-        NER_LABELS.append(ner_labels)
-        NER_OUTPUT.append(ner_output)
+    # cuDNN autotuning and TF32 only apply to the evaluation forward
+    with fast_cuda_flags(not trainer.args.no_cuda):
+        for batch in tqdm(iter(val_dtl)):
+            # Get labels
+            labels = batch.get('labels').numpy()
+            bs = labels.shape[0]
+            IC_LABELS[offset:offset+bs] = labels[:,0]
+            NER_LABELS[offset:offset+bs] = labels[:,1:]
+            # Labels stay on host as the model does not use them
+            batch = {k:batch[k].to(device, non_blocking=True) for k in ('input_ids', 'attention_mask')}
+            # Get output
+            with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=amp_dtype, enabled=not trainer.args.no_cuda):
+                ic_output, ner_output = forward_heads(**batch)
+            ic_buf[offset:offset+bs] = torch.argmax(ic_output, dim=-1)
+            ner_buf[offset:offset+bs] = torch.argmax(ner_output, dim=-1)
+            offset += bs
     # Build final objects
-    IC_LABELS = np.concatenate(IC_LABELS)
-    IC_OUTPUT = np.concatenate(IC_OUTPUT)
-    NER_LABELS = np.concatenate(NER_LABELS)
-    NER_OUTPUT = np.concatenate(NER_OUTPUT)
+    IC_OUTPUT = ic_buf.cpu().numpy()
+    NER_OUTPUT = ner_buf.cpu().numpy()
+    if distributed:
+        IC_LABELS, IC_OUTPUT, NER_LABELS, NER_OUTPUT = gather_distributed(np.array(list(val_dtl.sampler)),
+                                                                          [IC_LABELS, IC_OUTPUT, NER_LABELS, NER_OUTPUT],
+                                                                          len(val_dtl.dataset))
+        # Only the main process computes metrics
+        if torch.distributed.get_rank()!=0:
+            return {}, {}
+    # IC metrics from a (languages, labels, labels) confusion matrix. Label set is known
+    # beforehand, so no unique scans are needed to build it
+    langs, lang_idx = np.unique(language_arr, return_inverse=True)
+    n_ic = trainer.model.num_labels['IC']
+    cm_by_lang = np.bincount((lang_idx*n_ic + IC_LABELS)*n_ic + IC_OUTPUT, minlength=len(langs)*n_ic*n_ic).reshape((len(langs), n_ic, n_ic))
     # Compute global metrics
     log.info("Compute global metrics:")
-    accIC = accuracy_score(IC_LABELS, IC_OUTPUT)
-    f1IC = f1_score(IC_LABELS, IC_OUTPUT, average='macro')
-    f1NER, precision, recall = computeF1Score(NER_OUTPUT, NER_LABELS)
+    accIC, f1IC = confusionMatrixMetrics(cm_by_lang.sum(axis=0))
+    # NER arrays are kept as integer ids and only decoded to tags right before scoring
+    f1NER, precision, recall = computeF1Score(idx2ner_arr[NER_OUTPUT], idx2ner_arr[NER_LABELS])
     global_metrics={'accuracy_IC':accIC,'f1_IC':f1IC,'f1_NER':f1NER,'precision_NER':precision,'recall_NER':recall}
     # Compute language-wise metrics
     log.info("Compute language-wise metrics:")
     lang_metrics={}
-    for lang in tqdm(np.unique(language_arr)):
-        accIC = accuracy_score(IC_LABELS[language_arr==lang], IC_OUTPUT[language_arr==lang])
-        f1IC = f1_score(IC_LABELS[language_arr==lang], IC_OUTPUT[language_arr==lang], average='macro')
-        f1NER, precision, recall = computeF1Score(NER_OUTPUT[language_arr==lang], NER_LABELS[language_arr==lang])
-        lang_metrics[lang]={'accuracy_IC':accIC,'f1_IC':f1IC,'f1_NER':f1NER,'precision_NER':precision,'recall_NER':recall}
+    # Group samples by language once so each language is a contiguous slice
+    order = np.argsort(lang_idx, kind='stable')
+    bounds = np.searchsorted(lang_idx[order], np.arange(len(langs)+1))
+    NER_LABELS, NER_OUTPUT = NER_LABELS[order], NER_OUTPUT[order]
+    accIC_by_lang, f1IC_by_lang = confusionMatrixMetrics(cm_by_lang)
+    for i, lang in enumerate(tqdm(langs)):
+        lang_slice = slice(bounds[i], bounds[i+1])
+        f1NER, precision, recall = computeF1Score(idx2ner_arr[NER_OUTPUT[lang_slice]], idx2ner_arr[NER_LABELS[lang_slice]])
+        lang_metrics[lang]={'accuracy_IC':accIC_by_lang[i],'f1_IC':f1IC_by_lang[i],'f1_NER':f1NER,'precision_NER':precision,'recall_NER':recall}
     return global_metrics, lang_metrics
@@ -32,6 +32,16 @@ class LinearBlock(torch.nn.Module):
     def forward(self, x):
         return self.block(x)
 
+    # Sublayers are kept in the Sequential (dropout, linear, [layernorm, gelu]) so
+    # checkpoint keys do not change; these accessors are the only place relying on it
+    @property
+    def linear(self):
+        return self.block[1]
+
+    def forward_post_linear(self, x):
+        # Layers applied after the linear projection (identity without activation)
+        return self.block[2:](x)
+
 ## Format
 class DataFormat(torch.nn.Module):
     def __init__(self,
@@ -66,8 +76,17 @@ class NER2IC(torch.nn.Module):
     
     def forward(self, ic_tokens, ner_tokens):
         ner_tokens = torch.mean(ner_tokens, dim=1, keepdim=True)
-        ic_tokens = torch.bmm(torch.unsqueeze(ic_tokens, dim=-1), ner_tokens)
-        ic_tokens = torch.mean(self.Lblock_prior(ic_tokens), dim=1)
+        if self.training:
+            ic_tokens = torch.bmm(torch.unsqueeze(ic_tokens, dim=-1), ner_tokens)
+            ic_tokens = self.Lblock_prior(ic_tokens)
+        else:
+            # Without dropout, each row of the outer product goes through the linear layer as
+            # ic_i*(W·ner)+b, so project ner first and skip the (bs, dim, dim) intermediate
+            linear = self.Lblock_prior.linear
+            ner_tokens = torch.nn.functional.linear(ner_tokens, linear.weight)
+            ic_tokens = torch.bmm(torch.unsqueeze(ic_tokens, dim=-1), ner_tokens) + linear.bias
+            ic_tokens = self.Lblock_prior.forward_post_linear(ic_tokens)
+        ic_tokens = torch.mean(ic_tokens, dim=1)
         ic_tokens = self.Lblock_post(ic_tokens)
         return ic_tokens
 
@@ -125,15 +144,21 @@ class IC_NER_Model(torch.nn.Module):
         self.ner_layer = IC2NER(self.dim, self.num_labels['NER'], dropout, device)
     
     def forward(self, input_ids, attention_mask, labels=None):
+        # Reshape NER output as both will be concatenated to be a single output
+        ic_output, ner_output = self.forward_heads(input_ids, attention_mask)
+        ner_output = ner_output.reshape((-1, self.max_length*self.num_labels['NER']))
+        # Output
+        return torch.cat([ic_output, ner_output], dim=-1)
+
+    def forward_heads(self, input_ids, attention_mask):
         # Input
         ic_tokens, ner_tokens = self._disentangle_transformer(input_ids, attention_mask)
         ic_tokens, ner_tokens = self.LFormat(ic_tokens, ner_tokens)
-        # Info sharing. Reshape NER output as both will be concatenated to be 
-        # a single output
-        ner_output = self.ner_layer(ic_tokens, ner_tokens).reshape((-1, self.max_length*self.num_labels['NER']))
+        # Info sharing. IC output has shape (bs, labels['IC']) and NER output
+        # (bs, max_length, labels['NER']), both contiguous
+        ner_output = self.ner_layer(ic_tokens, ner_tokens)
         ic_output = self.ic_layer(ic_tokens, ner_tokens)
-        # Output
-        return torch.cat([ic_output, ner_output], dim=-1)
+        return ic_output, ner_output
     
     def _disentangle_transformer(self,
                                  input_ids:torch.Tensor,
@@ -3,6 +3,7 @@ import numpy as np
 import torch
 import random
 import os
+import contextlib
 
 # Set seed
 def seed_everything(seed=42):
@@ -14,6 +15,22 @@ def seed_everything(seed=42):
     torch.backends.cudnn.deterministic = True
 
 
+# Enable cuDNN autotuning and TF32 matmuls within the context only, restoring
+# the previous process-wide values on exit
+@contextlib.contextmanager
+def fast_cuda_flags(enabled=True):
+    prev_benchmark = torch.backends.cudnn.benchmark
+    prev_tf32 = torch.backends.cuda.matmul.allow_tf32
+    if enabled:
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+    try:
+        yield
+    finally:
+        torch.backends.cudnn.benchmark = prev_benchmark
+        torch.backends.cuda.matmul.allow_tf32 = prev_tf32
+
+
 # Method to ensemble NER outputs into one
 def convert_tags(tag, original_idxs):
     tag1, tag2= tag.split('.')[0], tag.split('.')[1]
@@ -47,6 +64,19 @@ def convert_tags(tag, original_idxs):
         return 'O'
 
 
+# Accuracy and macro F1-score from a stack of confusion matrices of shape
+# (..., n_classes, n_classes), rows being labels and columns predictions.
+# As in sklearn, the macro average only covers classes present in labels or
+# predictions
+def confusionMatrixMetrics(cm):
+    tp = np.diagonal(cm, axis1=-2, axis2=-1)
+    support = cm.sum(axis=-1) + cm.sum(axis=-2)
+    accuracy = tp.sum(axis=-1) / np.maximum(cm.sum(axis=(-2,-1)), 1)
+    f1 = np.divide(2*tp, support, out=np.zeros(support.shape), where=support>0)
+    f1_macro = f1.sum(axis=-1) / np.maximum((support>0).sum(axis=-1), 1)
+    return accuracy, f1_macro
+
+
 # Helper methods to compute F1-score in NER
 def startOfChunk(prevTag, tag, prevTagType, tagType, chunkStart=False):
     if prevTag == 'B' and tag == 'B':